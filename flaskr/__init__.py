@@ -10,7 +10,22 @@ Finally, the function will return the Flask application instance.
 """
 
 import os
-from flask import Flask
+from flask import Flask, render_template
+
+# default configuration the app will use, built once when the package is imported.
+# DATABASE isn't included since it lives in the instance folder, which is only known
+# once the app exists.
+_DEFAULT_CONFIG = {
+    'SECRET_KEY': "freemason-slinky-basin-grill",
+    'DATABASE_POOL_SIZE': 5, # max number of idle db connections kept open for reuse
+}
+
+# the /hello page never changes, so its body and headers are built once. Cache-Control lets
+# proxies and load balancers polling it answer from their cache instead of hitting the app.
+_HELLO = (
+    b'Hello World!',
+    {'Content-Type': 'text/plain', 'Cache-Control': 'public, max-age=3600'},
+)
 
 def create_app(test_config=None):
     """
@@ -21,8 +36,7 @@ def create_app(test_config=None):
     
     # sets some default configuration the app will use
     app.config.from_mapping(
-        SECRET_KEY="freemason-slinky-basin-grill",
-        DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        _DEFAULT_CONFIG, DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite')
     )
 
     if test_config is None:
@@ -42,22 +56,30 @@ def create_app(test_config=None):
 
     
     # ensure the instance folder exists
-    try:
-        os.makedirs(app.instance_path)
-    except OSError:
-        pass
+    os.makedirs(app.instance_path, exist_ok=True)
 
     # registers the database using init_db from db.py
     from . import db
     db.init_app(app) # after running this, a flaskr.sqlite file will be in an instance folder in the project
 
+    # sets up the cache used to avoid repeating lookups on every request
+    from . import cache
+    cache.init_app(app)
+
     # imports and registers auth blueprint
     from . import auth
     app.register_blueprint(auth.bp)
 
+    # the auth views redirect to 'index' after logging in or out, so the endpoint is
+    # associated with the / URL here. Until the blog blueprint provides the real view,
+    # it just renders the blog index template.
+    @app.route('/', endpoint='index')
+    def index():
+        return render_template('blog/index.html')
+
     # return a simple page that says hello to test
     @app.route('/hello')
     def hello():
-        return 'Hello World!'
+        return _HELLO
     
     return app
@@ -16,16 +16,127 @@ The blueprint is then registered with the application when it is available in th
 """
 
 import functools
+import sqlite3
+import time
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+from werkzeug.security import check_password_hash
+from flaskr.cache import cache
 from flaskr.db import get_db
 
 # BLUEPRINT
 # this creates a Blueprint named auth that preprends /auth to all URLs associated
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# SQL
+# every query used by the auth views, kept in one place so the exact same string is passed to
+# sqlite3 on every request, which lets the connection's statement cache (128 statements by
+# default, far more than needed here) reuse the compiled statement
+class _SQL:
+    INSERT_USER = 'INSERT INTO user (username, password) VALUES (?, ?)'
+    UPDATE_PASSWORD = 'UPDATE user SET password = ? WHERE id = ?'
+    SELECT_BY_NAME = 'SELECT id, password, session_version FROM user WHERE username = ?'
+    SELECT_SESSION_VERSION = 'SELECT session_version FROM user WHERE id = ?'
+    BUMP_SESSION_VERSION = 'UPDATE user SET session_version = session_version + 1 WHERE id = ?'
+
+# PASSWORD HASHING
+# a single argon2id hasher shared by every view, using the OWASP recommended parameters
+# (19 MiB of memory, 2 iterations). The hashes are stored as PHC strings in the TEXT column.
+# argon2 releases the GIL while hashing, so under a threaded server (e.g. gunicorn --threads)
+# other requests keep running while one login or registration is being hashed. The views stay
+# synchronous: Flask runs async views in their own event loop on the same worker thread, so
+# they wouldn't free the worker.
+PH = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+
+def _check_password(stored_hash, password):
+    """
+    Returns a (matches, needs_rehash) tuple for the password against the stored hash.
+
+    Users registered before the switch to argon2 still have werkzeug hashes. Those are
+    checked with werkzeug and always flagged for a rehash so they get upgraded the next
+    time the user logs in successfully.
+    """
+    try:
+        PH.verify(stored_hash, password)
+    except VerifyMismatchError:
+        return False, False
+    except InvalidHashError:
+        return check_password_hash(stored_hash, password), True
+
+    return True, PH.check_needs_rehash(stored_hash)
+
+
+def _retry(fn, *args, tries=5, base=0.005, fast_fail=0.1):
+    """
+    Calls fn(*args), retrying with exponential backoff (5ms, 10ms, 20ms, ...) if the
+    database is locked by another writer and SQLite gave up straight away (within
+    fast_fail seconds) instead of waiting on busy_timeout, e.g. when it refuses to wait
+    to avoid a deadlock. A locked error that arrives after SQLite already waited out
+    busy_timeout is raised, so a request never waits on the lock more than once.
+    Any other error, or running out of tries, is raised as usual.
+    """
+    for i in range(tries):
+        start = time.monotonic()
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            waited = time.monotonic() - start
+            if 'locked' not in str(e) or waited > fast_fail or i == tries - 1:
+                raise
+            time.sleep(base * (2 ** i))
+
+
+def _insert_users(db, rows):
+    """
+    Inserts (username, password hash) rows in a single transaction, so there is only one
+    commit no matter how many rows there are. Using the connection as a context manager
+    commits when the block succeeds and rolls back if it raises.
+    """
+    with db:
+        db.executemany(_SQL.INSERT_USER, rows)
+
+
+def _bulk_register(rows):
+    """
+    Registers many users at once from (username, password) pairs, e.g. when seeding
+    the database. Either every user is inserted or, if one fails, none of them are.
+    """
+    users = [(username, PH.hash(password)) for username, password in rows]
+    _retry(_insert_users, get_db(), users)
+
+
+@cache.memoize(timeout=60)
+def _session_version(user_id):
+    """
+    Returns the user's current session version, or None if there is no such user.
+    Sessions that were issued with an older version have been revoked.
+    The result is cached for 60 seconds, so the database is only asked on a cache miss.
+    """
+    # only one value is needed here, so a plain tuple row is enough and cheaper than sqlite3.Row
+    cursor = get_db().cursor()
+    cursor.row_factory = None
+    row = cursor.execute(_SQL.SELECT_SESSION_VERSION, (user_id,)).fetchone()
+
+    return row[0] if row is not None else None
+
+
+def revoke_sessions(user_id):
+    """
+    Logs the user out everywhere by bumping their session version, which makes every
+    session issued so far invalid. Call this after changing a user's username or password.
+
+    Only this process's cached version is dropped, other workers keep accepting the old
+    sessions until their cached version expires.
+    """
+    db = get_db()
+    _retry(db.execute, _SQL.BUMP_SESSION_VERSION, (user_id,))
+    _retry(db.commit)
+    cache.delete_memoized(_session_version, user_id)
+
 # VIEWS
 
 # Creates the Register view that will return a HTML form for them to fill out.
@@ -50,11 +161,10 @@ def register():
 
         # Insert new user in USER table for the db if no error and redirect to login page
         if error is None:
+            # only hash the password once validation passed, hashing is deliberately slow
+            pw_hash = PH.hash(password)
             try:
-                db.execute(
-                    "INSERT INTO user (username password) VALUES (? ?)", (username, generate_password_hash(password))
-                )
-                db.commit()
+                _retry(_insert_users, db, [(username, pw_hash)])
             except db.IntegrityError: # raises error if user exists already
                 error = f"User {username} is already registered. Please login instead."
             else:
@@ -62,87 +172,95 @@ def register():
             
         flash(error) # Flashes the error across the screen
 
-        # return register template if GET request
-        return render_template('auth/register.html')
-    
+    # return register template if GET request or the registration failed
+    return render_template('auth/register.html')
 
-    # Creates a Login view that will redirect user to home page
-    @bp.route('/login', methods=('GET', 'POST'))
-    def login():
 
-        # handle POST request
-        if request.method == 'POST':
+# Creates a Login view that will redirect user to home page
+@bp.route('/login', methods=('GET', 'POST'))
+def login():
 
-            # get username and password
-            username = request.form['username']
-            password = request.form['password']
+    # handle POST request
+    if request.method == 'POST':
 
-            # get db connection
-            db = get_db()
-            error = None
+        # get username and password
+        username = request.form['username']
+        password = request.form['password']
+
+        # get db connection
+        db = get_db()
+        error = None
 
-            # validate username and password in the form
-            if not username:
-                error = "Please enter a valid username."
-            elif not password:
-                error = "Please enter a password."
+        # validate username and password in the form
+        if not username:
+            error = "Please enter a valid username."
+        elif not password:
+            error = "Please enter a password."
 
+        if error is None:
             # search db for user
-            user = db.execute(
-                'SELECT * FROM user where username = ?', (username).fetchone()
-            )
+            user = db.execute(_SQL.SELECT_BY_NAME, (username,)).fetchone()
 
             # check that user exists in db
             if user is None:
                 error = "Incorrect username."
-            elif not check_password_hash(user['password'], password):
-                error = 'Incorrect password'
+            else:
+                password_ok, needs_rehash = _check_password(user['password'], password)
+                if not password_ok:
+                    error = 'Incorrect password'
+                elif needs_rehash:
+                    # the hashing parameters changed since this hash was made, store a fresh one
+                    _retry(db.execute, _SQL.UPDATE_PASSWORD, (PH.hash(password), user['id']))
+                    _retry(db.commit)
+
+        # store user id in session dict to be available for multiple requests
+        if error is None:
+            """
+            session is a dict that stores data across requests. When validation succeeds,
+            the user's id and username are stored in a new session, together with the
+            user's session version so the session can be revoked later.
+            Difference between g and session: https://stackoverflow.com/questions/32909851/flask-session-vs-g#:~:text=No%2C%20g,g%20is%20cleared.
 
-            # store user id in session dict to be available for multiple requests
-            if error is None:
-                """
-                session is a dict that stores data across requests. When validation succeeds,
-                the user id is stored in a new session.
-                Difference between g and session: https://stackoverflow.com/questions/32909851/flask-session-vs-g#:~:text=No%2C%20g,g%20is%20cleared.
+            The data is stored in a cookie that is sent to the browser and the browser then
+            sends it back with subsequent requests. 
 
-                The data is stored in a cookie that is sent to the browser and the browser then
-                sends it back with subsequent requests. 
+            Flask securely signs the data so that it can't be tampered with.
+            """
+            session.clear()
+            session['user'] = {'id': user['id'], 'username': username}
+            session['v'] = user['session_version']
+            return redirect(url_for('index'))
 
-                Flask securely signs the data so that it can't be tampered with.
-                """
-                session.clear()
-                session['user_id'] = user['id']
-                redirect(url_for('index'))
+        flash(error)
 
+    # handle GET request
+    return render_template('auth/login.html')
 
-        # handle GET request
-        return render_template('/auth/login.html')
-    
 
-    @bp.before_app_request
-    def load_logged_in_user():
-        """
-        This function runs before the view function no matter the URL requested. 
-        It checks if a user is logged in by checking if id is stored in session.
-        It gets the user's data from the database, and stores it on g.user which will last for 
-        the length of the request.
+@bp.before_app_request
+def load_logged_in_user():
+    """
+    This function runs before the view function no matter the URL requested. 
+    It checks if a user is logged in by checking if the user is stored in session.
+    The user's id and username are read straight from the signed session, and stored on
+    g.user which will last for the length of the request. The database is only asked for
+    the user's session version, and only when it isn't cached.
+
+    If a user is not logged in, or the session was revoked, g.user will be set to None.
+    """
+    user = session.get('user') # get user stored in session dict
 
-        If a user is not logged in, or the id doesn't exist, g.user will be set to None.
-        """
-        user_id = session.get('user_id') # get user id stored in session dict
+    if user is not None and session.get('v') != _session_version(user['id']):
+        session.clear() # the session was revoked or the user no longer exists
+        user = None
 
-        if user_id is None:
-            g.user = None
-        else:
-            g.user = get_db().execute(
-                'SELECT * FROM user where id = ?', (user_id)
-            ).fetchone()
+    g.user = user
 
 
 @bp.route('/logout')
 def logout():
     """
-    To logout, the user id must be removed from session. And load_logged_in_user won't
+    To logout, the user must be removed from session. And load_logged_in_user won't
     load a user on subsequent requests.
     """
     session.clear()
@@ -153,6 +271,17 @@ def logout():
 Since creating, editing and deleting blog posts will require a user to be logged in,
 a decorator can be used to check this for each view it is applied to.
 """
+@bp.record_once
+def _cache_login_path(state):
+    """
+    Builds the login path once when the blueprint is registered on the app, instead of
+    calling url_for on every request that login_required turns away. The path is stored
+    on the app it was built for, without a script root, since that comes from each request.
+    """
+    adapter = state.app.url_map.bind('localhost')
+    state.app.extensions['auth.login_path'] = adapter.build('auth.login')
+
+
 def login_required(view):
     """
     This decorator returns a new view function that wraps the original view it's applied to.
@@ -164,7 +293,7 @@ def login_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
         if g.user is None:
-            return redirect(url_for('auth.login'))
+            return redirect(request.script_root + current_app.extensions['auth.login_path'])
         
         return view(**kwargs)
     return wrapped_view
\ No newline at end of file
@@ -0,0 +1,23 @@
+"""
+Some data is looked up on almost every request but rarely changes, like the logged in
+user. Instead of asking the database for it every time, the result can be kept in a
+cache for a short while and handed back directly.
+
+Flask-Caching provides the cache. Like the database, it is set up inside the app
+factory by calling init_app, so the cache object itself can be imported anywhere.
+"""
+
+from flask_caching import Cache
+
+cache = Cache()
+
+
+def init_app(app):
+    """
+    This function connects the cache to the app. The cache type is read from the
+    CACHE_TYPE config value, which defaults to an in-process SimpleCache.
+
+    This function will be called in the app factory in __init__.py.
+    """
+    app.config.setdefault('CACHE_TYPE', 'SimpleCache')
+    cache.init_app(app)
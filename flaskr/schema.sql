@@ -6,7 +6,8 @@ DROP TABLE IF EXISTS post;
 CREATE TABLE USER(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL
+    password TEXT NOT NULL,
+    session_version INTEGER NOT NULL DEFAULT 0 -- bumped to revoke the user's sessions
 );
 
 CREATE TABLE POST(